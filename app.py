@@ -3,11 +3,14 @@ import os
 import sqlite3
 import secrets
 import hashlib
-import datetime
+import threading
+import orjson
+from pathlib import Path
 from typing import Optional, Dict, Any
 
 from fastapi import FastAPI, Request, Form, Depends, HTTPException
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, ORJSONResponse, Response
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
@@ -20,43 +23,54 @@ def current_user_id(request: Request) -> Optional[int]:
     return request.session.get("user_id")
 
 # --- App setup ---
-app = FastAPI(title="Kind Friend")
+app = FastAPI(title="Kind Friend", default_response_class=ORJSONResponse)
+app.add_middleware(GZipMiddleware, minimum_size=512)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
 
 # --- DB Setup ---
 DB_PATH = os.getenv("APP_DB_PATH", "app.db")
+_local = threading.local()
 
 def db():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
+    # One long-lived connection per worker thread; PRAGMAs are applied once when it is opened.
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA cache_size=-65536")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA mmap_size=268435456")
+        conn.execute("PRAGMA foreign_keys=ON")
+        _local.conn = conn
     return conn
 
 def init_db():
     conn = db()
-    cur = conn.cursor()
-    # users
-    cur.execute("""
+    # All DDL runs as one script inside a single transaction: one commit at startup.
+    conn.executescript("""
+        BEGIN;
+        -- users
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             email TEXT UNIQUE NOT NULL,
             password_hash TEXT NOT NULL,
             display_name TEXT,
             created_at TEXT NOT NULL
-        )
-    """)
-    # memories
-    cur.execute("""
+        );
+        -- memories
         CREATE TABLE IF NOT EXISTS memories (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER NOT NULL,
             content TEXT NOT NULL,
             created_at TEXT NOT NULL,
             FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
-        )
+        );
+        CREATE INDEX IF NOT EXISTS ix_memories_user_created ON memories(user_id, created_at);
+        COMMIT;
     """)
-    conn.commit()
-    conn.close()
 
 @app.on_event("startup")
 def _startup():
@@ -65,49 +79,95 @@ def _startup():
 # --- Auth helpers ---
 SECRET_KEY = os.getenv("SECRET_KEY", "dev-secret")
 serializer = URLSafeTimedSerializer(SECRET_KEY)
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+MAX_PASSWORD_CHARS = 1024
+# Auth responses carry credentials/reset links and must never be cached by browsers or proxies.
+NO_STORE = {"Cache-Control": "no-store, private"}
+password_hasher = bcrypt.using(rounds=BCRYPT_ROUNDS)
+
+def check_password_length(password: str):
+    # Refuse oversized input before it reaches bcrypt.
+    if len(password) > MAX_PASSWORD_CHARS:
+        raise HTTPException(status_code=400, detail="Password too long", headers=NO_STORE)
 
 def create_password_hash(password: str) -> str:
-    return bcrypt.hash(password)
+    return password_hasher.hash(password)
 
 def verify_password(password: str, hashed: str) -> bool:
     return bcrypt.verify(password, hashed)
 
-def get_user_by_email(email: str):
+def email_registered(email: str) -> bool:
     conn = db()
-    row = conn.execute("SELECT * FROM users WHERE email=?", (email,)).fetchone()
-    conn.close()
-    return row
+    return conn.execute("SELECT 1 FROM users WHERE email=?", (email,)).fetchone() is not None
+
+def get_user_auth(email: str):
+    conn = db()
+    return conn.execute("SELECT id, email, password_hash FROM users WHERE email=?", (email,)).fetchone()
 
 def create_user(email: str, password: str, display_name: Optional[str] = None):
     conn = db()
-    conn.execute(
-        "INSERT INTO users (email, password_hash, display_name, created_at) VALUES (?, ?, ?, ?)",
-        (email, create_password_hash(password), display_name, datetime.datetime.utcnow().isoformat())
-    )
-    conn.commit()
-    conn.close()
+    with conn:
+        conn.execute(
+            "INSERT INTO users (email, password_hash, display_name, created_at) VALUES (?, ?, ?, strftime('%Y-%m-%dT%H:%M:%f', 'now'))",
+            (email, create_password_hash(password), display_name)
+        )
 
 # --- Memory helpers ---
+MAX_MEMORY_CHARS = int(os.getenv("MAX_MEMORY_CHARS", "2000"))
+
 def get_memories(user_id: int):
     conn = db()
-    rows = conn.execute("SELECT * FROM memories WHERE user_id=? ORDER BY created_at ASC", (user_id,)).fetchall()
-    conn.close()
-    return rows
+    return conn.execute("SELECT * FROM memories WHERE user_id=? ORDER BY created_at ASC", (user_id,)).fetchall()
 
 def add_memory(user_id: int, content: str):
     conn = db()
-    conn.execute("INSERT INTO memories (user_id, content, created_at) VALUES (?, ?, ?)",
-                 (user_id, content, datetime.datetime.utcnow().isoformat()))
-    conn.commit()
-    conn.close()
+    with conn:
+        conn.execute("INSERT INTO memories (user_id, content, created_at) VALUES (?, ?, strftime('%Y-%m-%dT%H:%M:%f', 'now'))",
+                     (user_id, content))
+
+def make_memories_etag(user_id: int, count: int, last_id: Optional[int]) -> str:
+    # Memories are append/delete only and ids are never reused, so count + max id identifies the list.
+    # Weak: the same tag covers both the identity and gzip encodings of the list.
+    return 'W/"' + hashlib.md5(f"{user_id}:{count}:{last_id}".encode()).hexdigest() + '"'
+
+def memories_etag(user_id: int) -> str:
+    # Current tag without loading the rows; only used to answer If-None-Match.
+    conn = db()
+    count, last_id = conn.execute("SELECT COUNT(*), MAX(id) FROM memories WHERE user_id=?", (user_id,)).fetchone()
+    return make_memories_etag(user_id, count, last_id)
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    # Weak comparison (RFC 9110 13.1.2): ignore W/ prefixes, accept any tag in the list or "*".
+    if not if_none_match:
+        return False
+    opaque = etag.removeprefix("W/")
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == opaque:
+            return True
+    return False
 
 def forget_memory(user_id: int, memory_id: int):
     conn = db()
-    conn.execute("DELETE FROM memories WHERE id=? AND user_id=?", (memory_id, user_id))
-    conn.commit()
-    conn.close()
+    with conn:
+        conn.execute("DELETE FROM memories WHERE id=? AND user_id=?", (memory_id, user_id))
 
 # --- Routes ---
+# Constant replies are serialized once; a fresh Response is still built per request.
+RESET_OK_JSON = orjson.dumps({"message": "Password reset successful"})
+MEMORY_ADDED_JSON = orjson.dumps({"message": "Memory added"})
+MEMORY_DELETED_JSON = orjson.dumps({"message": "Memory deleted"})
+
+def json_bytes(body: bytes) -> Response:
+    return Response(body, media_type="application/json")
+
+FAVICON_SVG = Path("static/icon_chat.svg").read_bytes()
+
+@app.get("/favicon.svg", include_in_schema=False)
+def favicon():
+    # Templates link /favicon.svg?v=1; bump the version when the icon changes.
+    return Response(FAVICON_SVG, media_type="image/svg+xml",
+                    headers={"Cache-Control": "public, max-age=31536000, immutable"})
 
 @app.get("/", response_class=HTMLResponse)
 def home(request: Request):
@@ -116,24 +176,27 @@ def home(request: Request):
 
 @app.post("/signup")
 def signup(email: str = Form(...), password: str = Form(...), display_name: Optional[str] = Form(None)):
-    if get_user_by_email(email):
-        raise HTTPException(status_code=400, detail="Email already registered")
+    check_password_length(password)
+    if email_registered(email):
+        raise HTTPException(status_code=400, detail="Email already registered", headers=NO_STORE)
     create_user(email, password, display_name)
-    return RedirectResponse("/", status_code=303)
+    return RedirectResponse("/", status_code=303, headers=NO_STORE)
 
 @app.post("/login")
-def login(email: str = Form(...), password: str = Form(...)):
-    user = get_user_by_email(email)
+def login(response: Response, email: str = Form(...), password: str = Form(...)):
+    check_password_length(password)
+    user = get_user_auth(email)
     if not user or not verify_password(password, user["password_hash"]):
-        raise HTTPException(status_code=400, detail="Invalid credentials")
+        raise HTTPException(status_code=400, detail="Invalid credentials", headers=NO_STORE)
+    response.headers.update(NO_STORE)
     # TODO: Replace with session cookie handling
     return {"message": f"Logged in as {user['email']}"}
 
 @app.post("/forgot-password")
-def forgot_password(email: str = Form(...)):
-    user = get_user_by_email(email)
-    if not user:
-        raise HTTPException(status_code=400, detail="No such user")
+def forgot_password(response: Response, email: str = Form(...)):
+    if not email_registered(email):
+        raise HTTPException(status_code=400, detail="No such user", headers=NO_STORE)
+    response.headers.update(NO_STORE)
     token = serializer.dumps(email, salt="password-reset")
     reset_link = f"/reset-password/{token}"
     # TODO: send by email in production
@@ -144,31 +207,47 @@ def reset_password_form(request: Request, token: str):
     try:
         email = serializer.loads(token, salt="password-reset", max_age=3600)
     except (SignatureExpired, BadSignature):
-        raise HTTPException(status_code=400, detail="Invalid or expired token")
-    return templates.TemplateResponse("reset_password.html", {"request": request, "token": token})
+        raise HTTPException(status_code=400, detail="Invalid or expired token", headers=NO_STORE)
+    return templates.TemplateResponse("reset_password.html", {"request": request, "token": token}, headers=NO_STORE)
 
 @app.post("/reset-password/{token}")
 def reset_password(token: str, new_password: str = Form(...)):
+    check_password_length(new_password)
     try:
         email = serializer.loads(token, salt="password-reset", max_age=3600)
     except (SignatureExpired, BadSignature):
-        raise HTTPException(status_code=400, detail="Invalid or expired token")
+        raise HTTPException(status_code=400, detail="Invalid or expired token", headers=NO_STORE)
     conn = db()
-    conn.execute("UPDATE users SET password_hash=? WHERE email=?", (create_password_hash(new_password), email))
-    conn.commit()
-    conn.close()
-    return {"message": "Password reset successful"}
+    with conn:
+        conn.execute("UPDATE users SET password_hash=? WHERE email=?", (create_password_hash(new_password), email))
+    response = json_bytes(RESET_OK_JSON)
+    response.headers.update(NO_STORE)
+    return response
 
 @app.get("/memories/{user_id}")
-def view_memories(user_id: int):
-    return {"memories": [dict(r) for r in get_memories(user_id)]}
+def view_memories(request: Request, user_id: int):
+    headers = {"Cache-Control": "private, max-age=0, must-revalidate"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        etag = memories_etag(user_id)
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers={**headers, "ETag": etag})
+    # The 200 tag is derived from the rows being returned, so body and tag always agree.
+    rows = get_memories(user_id)
+    headers["ETag"] = make_memories_etag(user_id, len(rows), max((r["id"] for r in rows), default=None))
+    return ORJSONResponse({"memories": [dict(r) for r in rows]}, headers=headers)
 
 @app.post("/memories/{user_id}")
 def add_user_memory(user_id: int, content: str = Form(...)):
-    add_memory(user_id, content)
-    return {"message": "Memory added"}
+    if len(content) > MAX_MEMORY_CHARS:
+        raise HTTPException(status_code=400, detail="Memory too long")
+    try:
+        add_memory(user_id, content)
+    except sqlite3.IntegrityError:
+        raise HTTPException(status_code=404, detail="No such user")
+    return json_bytes(MEMORY_ADDED_JSON)
 
 @app.delete("/memories/{user_id}/{memory_id}")
 def delete_memory(user_id: int, memory_id: int):
     forget_memory(user_id, memory_id)
-    return {"message": "Memory deleted"}
+    return json_bytes(MEMORY_DELETED_JSON)